@@ -1,22 +1,36 @@
 import streamlit as st
-import pandas as pd
+import streamlit.components.v1 as components
 import numpy as np
+import os
 import time
 import json
+import hashlib
+import threading
+import heapq
+import tempfile
+import textwrap
 import re
 import requests
+import io
+import csv
 import zipfile
-from io import BytesIO
+import importlib.util
+import importlib.metadata
+from collections import OrderedDict, deque
+from datetime import datetime
+from zoneinfo import ZoneInfo
 import random
 
-# Intentar importar folium y streamlit_folium
-try:
+# Verificar si folium está instalado sin importarlo todavía
+folium_disponible = importlib.util.find_spec("folium") is not None
+version_folium = importlib.metadata.version("folium") if folium_disponible else None
+
+# Función para cargar folium recién cuando se necesita un mapa
+def cargar_folium():
+    """Importa folium y sus plugins en el primer uso"""
     import folium
-    from folium.plugins import MeasureControl, MiniMap, MarkerCluster
-    from streamlit_folium import folium_static
-    folium_disponible = True
-except ImportError:
-    folium_disponible = False
+    from folium import plugins
+    return folium, plugins
 
 # Configuración de la página
 st.set_page_config(
@@ -28,6 +42,29 @@ st.set_page_config(
 # Configuraciones globales
 API_BASE_URL = "https://aps.senasa.gob.ar/restapiprod/servicios/renspa"
 TIEMPO_ESPERA = 0.5
+RADIO_TIERRA = 6371008.8  # Radio medio terrestre en metros
+TOLERANCIA_SUPERFICIE = 0.10  # Diferencia relativa admitida entre superficie declarada y calculada
+CACHE_MAPAS_MAX_BYTES = int(os.environ.get("VISU_CACHE_MAPAS_MB", "64")) * 1024 * 1024
+CACHE_MAPAS_DIR = os.environ.get("VISU_CACHE_MAPAS_DIR")  # Si se define, los mapas desalojados se guardan en disco
+CACHE_MAPAS_DISCO_MAX_BYTES = int(os.environ.get("VISU_CACHE_MAPAS_DISCO_MB", "256")) * 1024 * 1024
+MEMORIA_MAXIMA_LOTE_BYTES = int(os.environ.get("VISU_MEMORIA_LOTE_MB", "32")) * 1024 * 1024  # Por encima, la búsqueda por lista se guarda en disco
+MAX_CAMPOS_MAPA = int(os.environ.get("VISU_MAX_CAMPOS_MAPA", "1000"))  # Por encima no se dibuja el mapa (folium usa ~25 KB por campo)
+MAX_VERTICES_MAPA = int(os.environ.get("VISU_MAX_VERTICES_MAPA", "40000"))  # Por encima se simplifican los contornos del mapa
+VERSION_MAPA = 1  # Incrementar al cambiar crear_mapa_mobile para invalidar la cache (la versión de folium ya entra en la huella)
+TTL_CACHE_CONSULTAS = int(os.environ.get("VISU_CACHE_CONSULTAS_HORAS", "12")) * 3600
+CACHE_CONSULTAS_MAX_BYTES = int(os.environ.get("VISU_CACHE_CONSULTAS_MB", "64")) * 1024 * 1024  # Tamaño estimado como JSON de campos y detalles
+VIDA_MEDIA_POPULARIDAD = 24 * 3600  # Las búsquedas pierden la mitad de su peso por día
+POPULARIDAD_MINIMA = 0.05  # Por debajo (unos 4 días sin búsquedas) el CUIT se deja de seguir
+POPULARIDAD_MAX_CUITS = 10000
+# Las caches y el calentador viven en cada proceso: con varias réplicas, cada una calienta su propia cache.
+# El presupuesto de llamadas es el total hacia la API y se reparte en partes iguales entre las VISU_REPLICAS.
+CALENTADOR_ACTIVO = os.environ.get("VISU_CALENTADOR", "1") == "1"
+CALENTADOR_HORARIO = os.environ.get("VISU_CALENTADOR_HORARIO", "2-6")  # Horas de poco uso (inicio-fin) en CALENTADOR_ZONA_HORARIA
+CALENTADOR_ZONA_HORARIA = ZoneInfo(os.environ.get("VISU_ZONA_HORARIA", "America/Argentina/Buenos_Aires"))  # Los contenedores suelen correr en UTC
+CALENTADOR_REPLICAS = max(1, int(os.environ.get("VISU_REPLICAS", "1")))
+CALENTADOR_LLAMADAS_POR_HORA = int(os.environ.get("VISU_CALENTADOR_LLAMADAS_HORA", "300")) // CALENTADOR_REPLICAS  # Por proceso
+CALENTADOR_MAX_CUITS = 50
+CALENTADOR_INTERVALO = 300  # Segundos entre pasadas
 
 # CSS personalizado para mobile con logo VISU
 st.markdown("""
@@ -205,8 +242,11 @@ def normalizar_cuit(cuit):
     return f"{cuit_limpio[:2]}-{cuit_limpio[2:10]}-{cuit_limpio[10]}"
 
 # Función para obtener datos por CUIT
-def obtener_datos_por_cuit(cuit):
-    """Obtiene todos los campos asociados a un CUIT"""
+def obtener_datos_por_cuit(cuit, puede_consultar=None):
+    """Obtiene todos los campos asociados a un CUIT como (campos, completo)
+
+    completo es False si falló alguna página o si puede_consultar() cortó la paginación.
+    """
     try:
         url_base = f"{API_BASE_URL}/consultaPorCuit"
         
@@ -214,8 +254,13 @@ def obtener_datos_por_cuit(cuit):
         offset = 0
         limit = 10
         has_more = True
+        completo = True
         
         while has_more:
+            if puede_consultar is not None and not puede_consultar():
+                completo = False
+                break
+            
             url = f"{url_base}?cuit={cuit}&offset={offset}"
             
             try:
@@ -232,13 +277,14 @@ def obtener_datos_por_cuit(cuit):
             
             except Exception as e:
                 has_more = False
+                completo = False
                 
             time.sleep(TIEMPO_ESPERA)
         
-        return todos_campos
+        return todos_campos, completo
     
     except Exception as e:
-        return []
+        return [], False
 
 # Función para consultar detalles de un campo específico
 def consultar_campo_detalle(renspa):
@@ -265,36 +311,677 @@ def extraer_coordenadas(poligono_str):
     if not coord_pairs:
         return None
     
-    coords_geojson = []
-    for lat_str, lon_str in coord_pairs:
-        try:
-            lat = float(lat_str)
-            lon = float(lon_str)
-            coords_geojson.append([lon, lat])
-        except ValueError:
-            continue
+    try:
+        coords_latlon = np.array(coord_pairs, dtype=np.float64)
+    except ValueError:
+        # Algún par no es numérico: descartar sólo los inválidos
+        validos = []
+        for lat_str, lon_str in coord_pairs:
+            try:
+                validos.append((float(lat_str), float(lon_str)))
+            except ValueError:
+                continue
+        coords_latlon = np.array(validos, dtype=np.float64).reshape(-1, 2)
     
-    if len(coords_geojson) >= 3:
-        if coords_geojson[0] != coords_geojson[-1]:
-            coords_geojson.append(coords_geojson[0])
+    if len(coords_latlon) >= 3:
+        # Array (N, 2) de [lon, lat] como en GeoJSON
+        coords_geojson = coords_latlon[:, ::-1]
+        if not np.array_equal(coords_geojson[0], coords_geojson[-1]):
+            coords_geojson = np.vstack([coords_geojson, coords_geojson[:1]])
         
-        return coords_geojson
+        return np.ascontiguousarray(coords_geojson)
     
     return None
 
+# Función para serializar a JSON valores con arrays de numpy
+def serializar_json(valor):
+    """Convierte arrays y escalares de numpy a tipos de Python para json.dumps"""
+    if isinstance(valor, (np.ndarray, np.generic)):
+        return valor.tolist()
+    return str(valor)
+
+# Cache compartida de consultas a la API
+class CacheConsultas:
+    """Cache LRU con vencimiento de las respuestas de la API, acotada en bytes, que registra la popularidad de cada CUIT"""
+
+    def __init__(self, ttl, max_bytes, vida_media, popularidad_minima, max_popularidad):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.vida_media = vida_media
+        self.popularidad_minima = popularidad_minima
+        self.max_popularidad = max_popularidad
+        # ('campos', cuit) o ('detalle', renspa) -> (timestamp, valor, calentado, bytes), del menos al más usado
+        self.entradas = OrderedDict()
+        self.bytes_usados = 0
+        self.cantidades = {'campos': 0, 'detalle': 0}
+        self.popularidad = {}  # cuit -> (puntaje, timestamp)
+        self.lock = threading.Lock()
+
+        # Estadísticas de búsquedas interactivas
+        self.consultas = 0
+        self.aciertos = 0
+        self.aciertos_calentados = 0
+
+    def _decaer(self, puntaje, segundos):
+        return puntaje * 0.5 ** (segundos / self.vida_media)
+
+    def _quitar(self, clave):
+        """Saca una entrada y descuenta sus bytes (llamar con el lock tomado)"""
+        entrada = self.entradas.pop(clave, None)
+        if entrada is not None:
+            self.bytes_usados -= entrada[3]
+            self.cantidades[clave[0]] -= 1
+
+    def _guardar(self, clave, valor, calentado):
+        """Guarda la respuesta y desaloja las menos usadas si se supera el límite de bytes"""
+        tamanio = len(json.dumps(valor, separators=(',', ':'), default=serializar_json))
+        with self.lock:
+            self._quitar(clave)
+            if tamanio > self.max_bytes:
+                return
+            self.entradas[clave] = (time.time(), valor, calentado, tamanio)
+            self.bytes_usados += tamanio
+            self.cantidades[clave[0]] += 1
+            while self.bytes_usados > self.max_bytes:
+                self._quitar(next(iter(self.entradas)))
+
+    def _buscar(self, clave):
+        with self.lock:
+            entrada = self.entradas.get(clave)
+            if entrada is None or time.time() - entrada[0] >= self.ttl:
+                return None
+            self.entradas.move_to_end(clave)
+            return entrada
+
+    def _podar_popularidad(self, ahora, maximo):
+        """Descarta los CUITs olvidados y deja como mucho `maximo` (llamar con el lock tomado)"""
+        puntajes = {}
+        for cuit, (puntaje, ultima) in self.popularidad.items():
+            actual = self._decaer(puntaje, ahora - ultima)
+            if actual >= self.popularidad_minima:
+                puntajes[cuit] = actual
+
+        if len(puntajes) > maximo:
+            puntajes = dict(heapq.nlargest(maximo, puntajes.items(), key=lambda item: item[1]))
+
+        self.popularidad = {cuit: self.popularidad[cuit] for cuit in puntajes}
+
+    def registrar_consulta(self, cuit):
+        """Suma una búsqueda a la popularidad del CUIT"""
+        ahora = time.time()
+        with self.lock:
+            puntaje, ultima = self.popularidad.get(cuit, (0.0, ahora))
+            self.popularidad[cuit] = (self._decaer(puntaje, ahora - ultima) + 1.0, ahora)
+
+            # Podar con margen para no recorrer el diccionario en cada búsqueda
+            if len(self.popularidad) > self.max_popularidad:
+                self._podar_popularidad(ahora, int(self.max_popularidad * 0.9))
+
+    def mas_populares(self, cantidad):
+        """Devuelve los CUITs más buscados, con la popularidad decayendo con el tiempo"""
+        ahora = time.time()
+        with self.lock:
+            self._podar_popularidad(ahora, self.max_popularidad)
+            puntajes = [(self._decaer(puntaje, ahora - ultima), cuit) for cuit, (puntaje, ultima) in self.popularidad.items()]
+        return [cuit for _, cuit in heapq.nlargest(cantidad, puntajes)]
+
+    def necesita_refresco(self, cuit, fraccion=0.75):
+        """Indica si el CUIT no está en la cache o está cerca de vencer"""
+        with self.lock:
+            entrada = self.entradas.get(('campos', cuit))
+        return entrada is None or time.time() - entrada[0] >= self.ttl * fraccion
+
+    def detalle_vigente(self, renspa):
+        return self._buscar(('detalle', renspa)) is not None
+
+    def guardar_campos(self, cuit, campos, completo, calentado=False):
+        # Sólo se cachean resultados con todas las páginas; los vacíos tampoco
+        if campos and completo:
+            self._guardar(('campos', cuit), campos, calentado)
+
+    def guardar_detalle(self, renspa, detalle, calentado=False):
+        if detalle:
+            self._guardar(('detalle', renspa), detalle, calentado)
+
+    def obtener_campos(self, cuit, registrar=True):
+        """Devuelve los campos del CUIT desde la cache o consultando la API
+
+        Con `registrar=False` la búsqueda no suma popularidad (búsquedas por lista), así un lote
+        grande no desplaza del calentador a los productores que se buscan de a uno.
+        """
+        if registrar:
+            self.registrar_consulta(cuit)
+        entrada = self._buscar(('campos', cuit))
+
+        with self.lock:
+            self.consultas += 1
+            if entrada is not None:
+                self.aciertos += 1
+                if entrada[2]:
+                    self.aciertos_calentados += 1
+
+        if entrada is not None:
+            return entrada[1]
+
+        campos, completo = obtener_datos_por_cuit(cuit)
+        self.guardar_campos(cuit, campos, completo)
+        return campos
+
+    def obtener_detalle(self, renspa):
+        """Devuelve el detalle del campo desde la cache o consultando la API"""
+        entrada = self._buscar(('detalle', renspa))
+        if entrada is not None:
+            return entrada[1]
+
+        detalle = consultar_campo_detalle(renspa)
+        self.guardar_detalle(renspa, detalle)
+        time.sleep(TIEMPO_ESPERA)
+        return detalle
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                'consultas': self.consultas,
+                'aciertos': self.aciertos,
+                'aciertos_calentados': self.aciertos_calentados,
+                'tasa_aciertos_calentados': self.aciertos_calentados / self.consultas if self.consultas else 0.0,
+                'cuits_en_cache': self.cantidades['campos'],
+                'detalles_en_cache': self.cantidades['detalle'],
+                'bytes_en_cache': self.bytes_usados
+            }
+
+# Precarga en segundo plano de los CUITs más buscados
+class CalentadorCache:
+    """Refresca los CUITs populares en horario de poco uso sin superar un presupuesto de llamadas por hora"""
+
+    def __init__(self, cache, horario, zona_horaria, llamadas_por_hora, max_cuits, intervalo):
+        self.cache = cache
+        self.hora_inicio, self.hora_fin = (int(h) for h in horario.split('-'))
+        self.zona_horaria = zona_horaria
+        self.llamadas_por_hora = llamadas_por_hora
+        self.max_cuits = max_cuits
+        self.intervalo = intervalo
+        self.llamadas_recientes = deque()  # timestamps de las llamadas de la última hora
+        self.lock = threading.Lock()
+        self.hilo = threading.Thread(target=self._bucle, name="calentador-cache", daemon=True)
+
+        # Estadísticas
+        self.llamadas_totales = 0
+        self.cuits_calentados = 0
+        self.ultima_pasada = None
+
+    def iniciar(self):
+        self.hilo.start()
+        return self
+
+    def en_horario_valle(self, ahora=None):
+        hora = datetime.fromtimestamp(time.time() if ahora is None else ahora, self.zona_horaria).hour
+        if self.hora_inicio <= self.hora_fin:
+            return self.hora_inicio <= hora < self.hora_fin
+        return hora >= self.hora_inicio or hora < self.hora_fin
+
+    def presupuesto_disponible(self):
+        """Llamadas que todavía se pueden hacer en la última hora"""
+        limite = time.time() - 3600
+        with self.lock:
+            while self.llamadas_recientes and self.llamadas_recientes[0] < limite:
+                self.llamadas_recientes.popleft()
+            return self.llamadas_por_hora - len(self.llamadas_recientes)
+
+    def reservar_llamada(self):
+        """Descuenta una llamada del presupuesto antes de hacerla; False si no queda"""
+        if self.presupuesto_disponible() <= 0:
+            return False
+        with self.lock:
+            self.llamadas_recientes.append(time.time())
+            self.llamadas_totales += 1
+        return True
+
+    def calentar(self):
+        """Hace una pasada sobre los CUITs más populares que estén por vencer"""
+        for cuit in self.cache.mas_populares(self.max_cuits):
+            if not self.cache.necesita_refresco(cuit):
+                continue
+
+            # Cada página se descuenta del presupuesto antes de pedirla
+            campos, completo = obtener_datos_por_cuit(cuit, puede_consultar=self.reservar_llamada)
+            if not completo:
+                if self.presupuesto_disponible() <= 0:
+                    break
+                continue
+
+            # Precargar los detalles de los campos que no traen polígono
+            for campo in campos:
+                if campo.get('poligono') or self.cache.detalle_vigente(campo['renspa']):
+                    continue
+                if not self.reservar_llamada():
+                    completo = False
+                    break
+                detalle = consultar_campo_detalle(campo['renspa'])
+                self.cache.guardar_detalle(campo['renspa'], detalle, calentado=True)
+                time.sleep(TIEMPO_ESPERA)
+
+            # Si faltaron detalles, el CUIT queda pendiente para la próxima pasada
+            if not completo:
+                break
+
+            self.cache.guardar_campos(cuit, campos, completo, calentado=True)
+            with self.lock:
+                self.cuits_calentados += 1
+
+        self.ultima_pasada = time.time()
+
+    def _bucle(self):
+        while True:
+            time.sleep(self.intervalo)
+            if not self.en_horario_valle():
+                continue
+            try:
+                self.calentar()
+            except Exception:
+                pass
+
+    def estadisticas(self):
+        disponible = self.presupuesto_disponible()
+        with self.lock:
+            return {
+                'llamadas_totales': self.llamadas_totales,
+                'llamadas_ultima_hora': self.llamadas_por_hora - disponible,
+                'cuits_calentados': self.cuits_calentados,
+                'ultima_pasada': self.ultima_pasada
+            }
+
+@st.cache_resource
+def obtener_cache_consultas():
+    """Cache de consultas compartida entre reruns y sesiones"""
+    return CacheConsultas(
+        TTL_CACHE_CONSULTAS,
+        CACHE_CONSULTAS_MAX_BYTES,
+        VIDA_MEDIA_POPULARIDAD,
+        POPULARIDAD_MINIMA,
+        POPULARIDAD_MAX_CUITS
+    )
+
+@st.cache_resource
+def obtener_calentador():
+    """Inicia una sola vez el calentador de la cache, si está activado"""
+    if not CALENTADOR_ACTIVO:
+        return None
+    return CalentadorCache(
+        obtener_cache_consultas(),
+        CALENTADOR_HORARIO,
+        CALENTADOR_ZONA_HORARIA,
+        CALENTADOR_LLAMADAS_POR_HORA,
+        CALENTADOR_MAX_CUITS,
+        CALENTADOR_INTERVALO
+    ).iniciar()
+
+# Función para empaquetar los anillos en arrays planos
+def empaquetar_anillos(poligonos):
+    """Concatena las coordenadas de todos los polígonos en un único array (N, 2) con los índices de inicio de cada anillo"""
+    longitudes = np.fromiter((len(p['coords']) for p in poligonos), dtype=np.int64, count=len(poligonos))
+    coords = np.concatenate([p['coords'] for p in poligonos])
+
+    inicios = np.zeros(len(poligonos), dtype=np.int64)
+    np.cumsum(longitudes[:-1], out=inicios[1:])
+
+    return coords, inicios, longitudes
+
+# Función para calcular superficies geodésicas de forma vectorizada
+def calcular_superficies_geodesicas(coords, inicios, longitudes):
+    """Calcula la superficie en hectáreas de cada anillo (lon, lat) cerrado sobre la esfera de radio medio terrestre"""
+    if len(inicios) == 0:
+        return np.zeros(0)
+
+    sen_lat = np.radians(coords[:, 1])
+    np.sin(sen_lat, out=sen_lat)
+
+    # Diferencia de longitud (en grados) entre cada vértice y el siguiente
+    termino = np.empty(len(coords))
+    np.subtract(coords[1:, 0], coords[:-1, 0], out=termino[:-1])
+    termino[-1] = 0.0
+
+    # Corregir los saltos que cruzan el antimeridiano
+    cruces = np.abs(termino) > 180.0
+    if cruces.any():
+        termino[cruces] -= np.copysign(360.0, termino[cruces])
+
+    # Término de exceso esférico: delta_lon * (2 + sen(lat1) + sen(lat2))
+    suma_senos = sen_lat[:-1] + sen_lat[1:]
+    suma_senos += 2.0
+    termino[:-1] *= suma_senos
+
+    # El último vértice de cada anillo no se une con el primero del siguiente
+    termino[inicios + longitudes - 1] = 0.0
+
+    sumas = np.add.reduceat(termino, inicios)
+    sumas[longitudes < 4] = 0.0
+
+    return np.abs(sumas) * np.radians(1.0) * (RADIO_TIERRA ** 2) / 2.0 / 10000.0
+
+# Función para validar la superficie declarada contra la calculada
+def validar_superficies(poligonos, tolerancia=None):
+    """Agrega a cada polígono 'superficie_calculada' y 'superficie_difiere' según la tolerancia relativa"""
+    if not poligonos:
+        return poligonos
+
+    if tolerancia is None:
+        tolerancia = TOLERANCIA_SUPERFICIE
+
+    calculadas = calcular_superficies_geodesicas(*empaquetar_anillos(poligonos))
+
+    # Las superficies faltantes quedan como NaN sólo para la comparación
+    declaradas = np.fromiter(
+        (np.nan if p.get('superficie') is None else p['superficie'] for p in poligonos),
+        dtype=np.float64,
+        count=len(poligonos)
+    )
+
+    con_declarada = declaradas > 0
+    diferencia = np.abs(calculadas - declaradas)
+    difiere = con_declarada & (diferencia > tolerancia * np.where(con_declarada, declaradas, 1.0))
+
+    for pol, calculada, flag in zip(poligonos, calculadas.tolist(), difiere.tolist()):
+        pol['superficie_calculada'] = calculada
+        pol['superficie_difiere'] = flag
+
+    return poligonos
+
+# Función para obtener la superficie a mostrar
+def superficie_efectiva(pol):
+    """Devuelve la superficie declarada o, si falta, la calculada"""
+    return pol.get('superficie') or pol.get('superficie_calculada', 0)
+
+# Almacén de polígonos para procesar listas grandes de CUITs
+class AlmacenPoligonos:
+    """Guarda polígonos en memoria hasta un presupuesto de bytes y vuelca el resto a un archivo temporal
+
+    Una vez cargado se puede recorrer desde varios hilos a la vez (las descargas diferidas corren aparte).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.buffer = []
+        self.bytes_buffer = 0
+        self.archivo = None
+        self.hash = hashlib.sha256()
+        self.lock = threading.Lock()
+        self.cerrado = False
+
+        # Métricas calculadas a medida que se agregan polígonos
+        self.cantidad = 0
+        self.vertices = 0
+        self.activos = 0
+        self.con_diferencia = 0
+        self.superficie_total = 0.0
+
+    def __len__(self):
+        return self.cantidad
+
+    def __iter__(self):
+        if self.cerrado:
+            raise ValueError("El almacén de polígonos ya fue cerrado")
+        archivo = self.archivo
+        if archivo is not None:
+            # Cada recorrido lleva su propia posición; el archivo se comparte bajo el lock
+            posicion = 0
+            while True:
+                with self.lock:
+                    archivo.seek(posicion)
+                    linea = archivo.readline()
+                    posicion = archivo.tell()
+                if not linea:
+                    break
+                yield self._leer(linea)
+        for linea in list(self.buffer):
+            yield self._leer(linea)
+
+    def _leer(self, linea):
+        pol = json.loads(linea)
+        pol['coords'] = np.array(pol['coords'], dtype=np.float64)
+        return pol
+
+    @property
+    def huella(self):
+        return self.hash.hexdigest()
+
+    def agregar(self, pol):
+        """Agrega un polígono y actualiza las métricas"""
+        linea = json.dumps(pol, separators=(',', ':'), default=serializar_json) + '\n'
+        self.hash.update(linea.encode('utf-8'))
+        self.buffer.append(linea)
+        self.bytes_buffer += len(linea)
+
+        self.cantidad += 1
+        self.vertices += len(pol['coords'])
+        self.superficie_total += superficie_efectiva(pol)
+        if pol.get('activo', True):
+            self.activos += 1
+        if pol.get('superficie_difiere'):
+            self.con_diferencia += 1
+
+        if self.bytes_buffer > self.max_bytes:
+            self.volcar()
+
+    def volcar(self):
+        """Escribe el buffer en el archivo temporal y libera la memoria"""
+        if not self.buffer:
+            return
+        with self.lock:
+            if self.archivo is None:
+                self.archivo = tempfile.TemporaryFile()
+            self.archivo.seek(0, os.SEEK_END)
+            self.archivo.writelines(linea.encode('utf-8') for linea in self.buffer)
+            self.archivo.flush()
+        self.buffer = []
+        self.bytes_buffer = 0
+
+    def cerrar(self):
+        """Elimina el archivo temporal"""
+        with self.lock:
+            self.cerrado = True
+            if self.archivo is not None:
+                self.archivo.close()
+                self.archivo = None
+        self.buffer = []
+        self.bytes_buffer = 0
+
+# Función para generar un CSV sin depender de pandas
+def generar_csv(filas, archivo):
+    """Escribe en el archivo binario el CSV UTF-8 de diccionarios con las mismas claves"""
+    texto = io.TextIOWrapper(archivo, encoding='utf-8', newline='')
+    filas = iter(filas)
+    primera = next(filas, None)
+    if primera is not None:
+        writer = csv.DictWriter(texto, fieldnames=list(primera.keys()), lineterminator='\n')
+        writer.writeheader()
+        writer.writerow(primera)
+        writer.writerows(filas)
+    texto.flush()
+    texto.detach()
+
+# Función para generar el KMZ de los polígonos
+def generar_kmz(poligonos, archivo):
+    """Escribe en el archivo un KMZ con el KML generado polígono por polígono"""
+    with zipfile.ZipFile(archivo, 'w', zipfile.ZIP_DEFLATED) as kmz:
+        with kmz.open("doc.kml", 'w') as kml:
+            kml.write(f"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+  <name>Campos del productor</name>
+  <Style id="redPoly">
+    <LineStyle>
+      <color>ff0000ff</color>
+      <width>3</width>
+    </LineStyle>
+    <PolyStyle>
+      <color>7f0000ff</color>
+    </PolyStyle>
+  </Style>
+""".encode('utf-8'))
+
+            for pol in poligonos:
+                placemark = f"""
+  <Placemark>
+    <name>{pol['titular']}</name>
+    <description>Localidad: {pol['localidad']} - Superficie: {superficie_efectiva(pol):.1f} ha</description>
+    <styleUrl>#redPoly</styleUrl>
+    <Polygon>
+      <outerBoundaryIs>
+        <LinearRing>
+          <coordinates>
+"""
+                placemark += "".join(f"{lon},{lat},0\n" for lon, lat in pol['coords'].tolist())
+                placemark += """
+          </coordinates>
+        </LinearRing>
+      </outerBoundaryIs>
+    </Polygon>
+  </Placemark>
+"""
+                kml.write(placemark.encode('utf-8'))
+
+            kml.write("</Document></kml>".encode('utf-8'))
+
+# Función para generar el GeoJSON de los polígonos
+def generar_geojson(poligonos, archivo, compacto=False):
+    """Escribe en el archivo un FeatureCollection, un feature a la vez (sin sangría si es compacto)"""
+    if compacto:
+        archivo.write(b'{"type":"FeatureCollection","features":[')
+    else:
+        archivo.write(b'{\n  "type": "FeatureCollection",\n  "features": [')
+    separador = b'' if compacto else b'\n'
+    for pol in poligonos:
+        feature = {
+            "type": "Feature",
+            "properties": {
+                "titular": pol['titular'],
+                "localidad": pol['localidad'],
+                "superficie": pol['superficie'],
+                "superficie_calculada": round(pol['superficie_calculada'], 2),
+                "superficie_difiere": pol['superficie_difiere'],
+                "cuit": pol['cuit'],
+                "estado": "Activo" if pol.get('activo', True) else "Inactivo",
+                "fecha_baja": pol.get('fecha_baja', None)
+            },
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [pol['coords'].tolist()]
+            }
+        }
+        archivo.write(separador)
+        if compacto:
+            archivo.write(json.dumps(feature, separators=(',', ':')).encode('utf-8'))
+            separador = b','
+        else:
+            archivo.write(textwrap.indent(json.dumps(feature, indent=2), "    ").encode('utf-8'))
+            separador = b',\n'
+
+    if compacto:
+        archivo.write(b']}')
+    else:
+        # Sin features queda "[]" como en json.dumps
+        archivo.write(b']\n}' if separador == b'\n' else b'\n  ]\n}')
+
+# Función para generar las filas del CSV
+def filas_csv(poligonos):
+    """Devuelve las filas del CSV de a una"""
+    for p in poligonos:
+        yield {
+            'Titular': p['titular'],
+            'Localidad': p['localidad'],
+            'Superficie (ha)': p['superficie'],
+            'Superficie calculada (ha)': round(p['superficie_calculada'], 2),
+            'Diferencia de superficie': 'Sí' if p['superficie_difiere'] else 'No',
+            'Estado': 'Activo' if p.get('activo', True) else 'Inactivo',
+            'Fecha de baja': p.get('fecha_baja', 'N/A'),
+            'CUIT': p['cuit']
+        }
+
+# Función para generar un archivo de descarga en un temporal
+def generar_en_disco(generar):
+    """Escribe un archivo de descarga en un temporal y lo devuelve sin buffer (RawIOBase) desde el inicio"""
+    archivo = tempfile.TemporaryFile()
+    try:
+        generar(archivo)
+        archivo.seek(0)
+    except BaseException:
+        archivo.close()
+        raise
+    # Separar el archivo crudo para que siga abierto cuando se libere el buffer
+    return archivo.detach()
+
+# Función para mostrar los botones de descarga
+def mostrar_descargas(poligonos, nombre_archivo, diferido=False):
+    """Muestra los botones de descarga KMZ, GeoJSON y CSV generando cada archivo en disco
+
+    Con `diferido`, cada archivo se genera recién cuando se pide (búsqueda por lista), así que
+    `poligonos` tiene que seguir abierto mientras los botones estén en pantalla.
+    """
+    st.subheader("📥 Descargar resultados")
+    col1, col2, col3 = st.columns(3)
+
+    descargas = [
+        (col1, "Descargar KMZ", "kmz", "application/vnd.google-earth.kmz",
+         lambda archivo: generar_kmz(poligonos, archivo)),
+        (col2, "Descargar GeoJSON", "geojson", "application/json",
+         lambda archivo: generar_geojson(poligonos, archivo, compacto=diferido)),
+        (col3, "Descargar CSV", "csv", "text/csv",
+         lambda archivo: generar_csv(filas_csv(poligonos), archivo)),
+    ]
+
+    for columna, etiqueta, extension, mime, generar in descargas:
+        if diferido:
+            with columna:
+                # Streamlit llama a la función en otro hilo al hacer clic, sin volver a correr la página
+                st.download_button(
+                    label=etiqueta,
+                    data=lambda generar=generar: generar_en_disco(generar),
+                    file_name=f"{nombre_archivo}.{extension}",
+                    mime=mime,
+                    on_click="ignore",
+                )
+            continue
+
+        with tempfile.TemporaryFile() as archivo:
+            generar(archivo)
+            archivo.flush()
+            with columna:
+                # El archivo sin buffer (RawIOBase) lo acepta download_button
+                st.download_button(
+                    label=etiqueta,
+                    data=archivo.raw,
+                    file_name=f"{nombre_archivo}.{extension}",
+                    mime=mime,
+                )
+
+# Función para reducir los vértices de un contorno antes de dibujarlo
+def simplificar_anillo(coords, paso):
+    """Toma un vértice cada `paso` de un anillo cerrado, conservando al menos un triángulo"""
+    if paso <= 1:
+        return coords
+    reducido = coords[:-1:paso]
+    if len(reducido) < 3:
+        return coords
+    return np.concatenate([reducido, reducido[:1]])
+
 # Función para crear mapa optimizado para mobile
-def crear_mapa_mobile(poligonos, center=None, cuit_colors=None):
-    """Crea un mapa folium optimizado para móvil"""
+def crear_mapa_mobile(poligonos, center=None, cuit_colors=None, paso=1):
+    """Crea un mapa folium optimizado para móvil, tomando un vértice cada `paso` en los contornos"""
     if not folium_disponible:
-        st.warning("Para visualizar mapas, instala folium y streamlit-folium con: pip install folium streamlit-folium")
+        st.warning("Para visualizar mapas, instala folium con: pip install folium")
         return None
     
+    folium, plugins = cargar_folium()
+    
+    # Primer polígono (funciona tanto con listas como con AlmacenPoligonos)
+    primer_poligono = next(iter(poligonos), None)
+    
     # Determinar centro del mapa
     if center:
         center_lat, center_lon = center
-    elif poligonos:
-        center_lat = poligonos[0]['coords'][0][1]
-        center_lon = poligonos[0]['coords'][0][0]
+    elif primer_poligono:
+        center_lon, center_lat = primer_poligono['coords'][0].tolist()
     else:
         center_lat = -34.603722
         center_lon = -58.381592
@@ -321,7 +1008,7 @@ def crear_mapa_mobile(poligonos, center=None, cuit_colors=None):
     
     # Añadir MiniMap
     try:
-        MiniMap(toggle_display=True).add_to(m)
+        plugins.MiniMap(toggle_display=True).add_to(m)
     except:
         pass
     
@@ -332,9 +1019,9 @@ def crear_mapa_mobile(poligonos, center=None, cuit_colors=None):
     if not cuit_colors:
         color_default = colores_disponibles[0]  # Rojo por defecto
         cuit_colors = {}
-        if poligonos:
+        if primer_poligono:
             # Obtener el CUIT del primer polígono y asignar el color
-            primer_cuit = poligonos[0].get('cuit')
+            primer_cuit = primer_poligono.get('cuit')
             if primer_cuit:
                 cuit_colors[primer_cuit] = color_default
     
@@ -368,10 +1055,14 @@ def crear_mapa_mobile(poligonos, center=None, cuit_colors=None):
         <div style='font-family: Arial; font-size: 14px; color: #333;'>
         <b>Campo:</b> {pol.get('titular', 'Sin información')}<br>
         <b>Localidad:</b> {pol.get('localidad', 'Sin información')}<br>
-        <b>Superficie:</b> {pol.get('superficie', 0):.1f} ha<br>
+        <b>Superficie:</b> {superficie_efectiva(pol):.1f} ha<br>
         <b>Estado:</b> {'Activo' if pol.get('activo', True) else 'Inactivo'}
         """
         
+        # Si la superficie declarada no coincide con la calculada, mostrar ambas
+        if pol.get('superficie_difiere'):
+            popup_text += f"<br><b>Superficie calculada:</b> {pol.get('superficie_calculada', 0):.1f} ha"
+        
         # Si el campo está inactivo, mostrar fecha de baja
         if not pol.get('activo', True) and pol.get('fecha_baja'):
             popup_text += f"<br><b>Trabajado hasta:</b> {pol.get('fecha_baja', 'No disponible')}"
@@ -380,7 +1071,7 @@ def crear_mapa_mobile(poligonos, center=None, cuit_colors=None):
         
         # Añadir polígono al grupo
         folium.Polygon(
-            locations=[[coord[1], coord[0]] for coord in pol['coords']],
+            locations=simplificar_anillo(pol['coords'], paso)[:, ::-1].tolist(),
             color=color,
             weight=weight,
             fill=True,
@@ -401,6 +1092,213 @@ def crear_mapa_mobile(poligonos, center=None, cuit_colors=None):
     
     return m
 
+# Cache del HTML de mapas ya renderizados
+class CacheMapasHTML:
+    """Cache LRU en memoria del HTML de mapas, acotada en bytes y con volcado opcional a disco también acotado"""
+
+    def __init__(self, max_bytes, directorio=None, max_bytes_disco=0):
+        self.max_bytes = max_bytes
+        self.directorio = directorio
+        self.max_bytes_disco = max_bytes_disco
+        self.entradas = OrderedDict()
+        self.bytes_usados = 0
+        self.archivos = OrderedDict()  # huella -> bytes en disco, del más viejo al más nuevo
+        self.escribiendo = set()  # huellas reservadas en el índice cuyo archivo todavía se está escribiendo
+        self.bytes_disco = 0
+        self.lock = threading.Lock()
+
+        if self.directorio:
+            os.makedirs(self.directorio, exist_ok=True)
+            self._indexar_disco()
+
+    def _ruta(self, huella):
+        return os.path.join(self.directorio, f"{huella}.html")
+
+    def _indexar_disco(self):
+        """Registra los archivos que quedaron de ejecuciones anteriores, del más viejo al más nuevo"""
+        existentes = []
+        for nombre in os.listdir(self.directorio):
+            if not nombre.endswith('.html'):
+                continue
+            ruta = os.path.join(self.directorio, nombre)
+            try:
+                info = os.stat(ruta)
+            except OSError:
+                continue
+            existentes.append((info.st_mtime, nombre[:-len('.html')], info.st_size))
+
+        with self.lock:
+            for _, huella, tamanio in sorted(existentes):
+                self.archivos[huella] = tamanio
+                self.bytes_disco += tamanio
+            sobrantes = self._recortar_disco()
+        self._borrar_archivos(sobrantes)
+
+    def _quitar_del_indice(self, huella):
+        """Saca la huella del índice de disco (llamar con el lock tomado)"""
+        self.bytes_disco -= self.archivos.pop(huella, 0)
+        self.escribiendo.discard(huella)
+
+    def _recortar_disco(self):
+        """Saca del índice los archivos más viejos hasta respetar el límite de disco (llamar con el lock tomado)
+
+        Devuelve las huellas cuyos archivos hay que borrar, fuera del lock.
+        """
+        sobrantes = []
+        while self.archivos and self.bytes_disco > self.max_bytes_disco:
+            huella = next(iter(self.archivos))
+            self._quitar_del_indice(huella)
+            sobrantes.append(huella)
+        return sobrantes
+
+    def _borrar_archivos(self, huellas):
+        """Elimina del disco los archivos de las huellas indicadas (llamar sin el lock)"""
+        for huella in huellas:
+            try:
+                os.remove(self._ruta(huella))
+            except OSError:
+                pass
+
+    def obtener(self, huella):
+        """Devuelve el HTML cacheado o None si no existe"""
+        with self.lock:
+            html = self.entradas.get(huella)
+            if html is not None:
+                self.entradas.move_to_end(huella)
+                return html
+
+            if not self.directorio or huella not in self.archivos or huella in self.escribiendo:
+                return None
+
+            # Se reclama la entrada bajo el lock; lo que vuelve a memoria ya no necesita estar en disco
+            self._quitar_del_indice(huella)
+
+        try:
+            with open(self._ruta(huella), 'r', encoding='utf-8') as f:
+                html = f.read()
+        except OSError:
+            html = None
+        self._borrar_archivos([huella])
+
+        if html is not None:
+            self.guardar(huella, html)
+        return html
+
+    def guardar(self, huella, html):
+        """Guarda el HTML y desaloja los más antiguos si se supera el límite de memoria"""
+        tamanio = len(html.encode('utf-8'))
+        desalojados = []
+        a_escribir = []
+        sobrantes = []
+
+        with self.lock:
+            if huella in self.entradas:
+                self.bytes_usados -= len(self.entradas.pop(huella).encode('utf-8'))
+
+            if tamanio <= self.max_bytes:
+                self.entradas[huella] = html
+                self.bytes_usados += tamanio
+            else:
+                desalojados.append((huella, html))
+
+            while self.bytes_usados > self.max_bytes:
+                huella_vieja, html_viejo = self.entradas.popitem(last=False)
+                self.bytes_usados -= len(html_viejo.encode('utf-8'))
+                desalojados.append((huella_vieja, html_viejo))
+
+            # Reservar en el índice lo que se vuelca a disco, sin pasar el límite; la escritura va fuera del lock
+            if self.directorio:
+                for huella_vieja, html_viejo in desalojados:
+                    datos = html_viejo.encode('utf-8')
+                    if huella_vieja in self.archivos or len(datos) > self.max_bytes_disco:
+                        continue
+                    self.archivos[huella_vieja] = len(datos)
+                    self.bytes_disco += len(datos)
+                    self.escribiendo.add(huella_vieja)
+                    a_escribir.append((huella_vieja, datos))
+                sobrantes = self._recortar_disco()
+
+        self._borrar_archivos(sobrantes)
+
+        for huella_vieja, datos in a_escribir:
+            try:
+                with open(self._ruta(huella_vieja), 'wb') as f:
+                    f.write(datos)
+                escrito = True
+            except OSError:
+                escrito = False
+
+            with self.lock:
+                # Si mientras tanto se recortó del índice, el archivo sobra
+                vigente = huella_vieja in self.escribiendo
+                if vigente and not escrito:
+                    self._quitar_del_indice(huella_vieja)
+                self.escribiendo.discard(huella_vieja)
+            if not vigente or not escrito:
+                self._borrar_archivos([huella_vieja])
+
+@st.cache_resource
+def obtener_cache_mapas():
+    """Cache de mapas compartida entre reruns y sesiones"""
+    return CacheMapasHTML(CACHE_MAPAS_MAX_BYTES, CACHE_MAPAS_DIR, CACHE_MAPAS_DISCO_MAX_BYTES)
+
+# Función para calcular la huella de un conjunto de polígonos
+def huella_mapa(poligonos, center=None, cuit_colors=None, paso=1):
+    """Calcula un hash del contenido que determina el HTML del mapa"""
+    # El almacén ya lleva un hash de su contenido, no hace falta volver a leerlo
+    if isinstance(poligonos, AlmacenPoligonos):
+        poligonos = poligonos.huella
+    
+    contenido = json.dumps(
+        [VERSION_MAPA, version_folium, paso, center, cuit_colors or {}, poligonos],
+        sort_keys=True,
+        default=serializar_json
+    )
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+
+# Función para obtener el HTML del mapa, usando la cache si es posible
+def renderizar_mapa_html(poligonos, center=None, cuit_colors=None, paso=1):
+    """Devuelve el HTML del mapa, renderizándolo sólo si no está en la cache"""
+    if not folium_disponible:
+        st.warning("Para visualizar mapas, instala folium con: pip install folium")
+        return None
+
+    cache = obtener_cache_mapas()
+    huella = huella_mapa(poligonos, center=center, cuit_colors=cuit_colors, paso=paso)
+
+    html = cache.obtener(huella)
+    if html is None:
+        mapa = crear_mapa_mobile(poligonos, center=center, cuit_colors=cuit_colors, paso=paso)
+        if not mapa:
+            return None
+        folium, _ = cargar_folium()
+        html = folium.Figure().add_child(mapa).render()
+        cache.guardar(huella, html)
+
+    return html
+
+# Función para mostrar el mapa en la página
+def mostrar_mapa(poligonos, center=None, cuit_colors=None, height=600):
+    """Muestra el mapa a partir del HTML cacheado, acotando campos y vértices dibujados"""
+    if isinstance(poligonos, AlmacenPoligonos):
+        cantidad, vertices = poligonos.cantidad, poligonos.vertices
+    else:
+        cantidad, vertices = len(poligonos), sum(len(pol['coords']) for pol in poligonos)
+
+    if cantidad > MAX_CAMPOS_MAPA:
+        st.info(f"El mapa se omite porque hay {cantidad} campos (máximo {MAX_CAMPOS_MAPA}). Usá las descargas para verlos en Google Earth o QGIS.")
+        return
+
+    # Con muchos vértices, se dibuja un vértice cada `paso` para acotar la memoria de folium
+    paso = -(-vertices // MAX_VERTICES_MAPA) if MAX_VERTICES_MAPA > 0 else 1
+    html = renderizar_mapa_html(poligonos, center=center, cuit_colors=cuit_colors, paso=paso)
+    if html:
+        components.html(html, height=height + 10)
+
+# Cache de consultas y calentador en segundo plano
+cache_consultas = obtener_cache_consultas()
+calentador = obtener_calentador()
+
 # Crear tabs
 tab1, tab2 = st.tabs(["🔍 Buscar por CUIT", "📋 Lista de CUITs"])
 
@@ -423,7 +1321,7 @@ with tab1:
                 cuit_normalizado = normalizar_cuit(cuit_input)
                 
                 with st.spinner('Buscando información...'):
-                    campos = obtener_datos_por_cuit(cuit_normalizado)
+                    campos = cache_consultas.obtener_campos(cuit_normalizado)
                     
                     if not campos:
                         st.error("No se encontraron campos para este CUIT")
@@ -449,7 +1347,7 @@ with tab1:
                         # Primero intentar con los datos que ya tenemos
                         if 'poligono' in campo and campo['poligono']:
                             coords = extraer_coordenadas(campo['poligono'])
-                            if coords:
+                            if coords is not None:
                                 poligonos.append({
                                     'coords': coords,
                                     'titular': campo.get('titular', ''),
@@ -462,13 +1360,13 @@ with tab1:
                                 continue
                         
                         # Si no tenemos polígono, consultar detalle
-                        resultado_detalle = consultar_campo_detalle(renspa)
+                        resultado_detalle = cache_consultas.obtener_detalle(renspa)
                         
                         if resultado_detalle and 'items' in resultado_detalle and resultado_detalle['items']:
                             item_detalle = resultado_detalle['items'][0]
                             if 'poligono' in item_detalle and item_detalle['poligono']:
                                 coords = extraer_coordenadas(item_detalle['poligono'])
-                                if coords:
+                                if coords is not None:
                                     poligonos.append({
                                         'coords': coords,
                                         'titular': campo.get('titular', ''),
@@ -484,8 +1382,9 @@ with tab1:
                                 poligonos_sin_coords.append(campo)
                         else:
                             poligonos_sin_coords.append(campo)
-                        
-                        time.sleep(TIEMPO_ESPERA)
+                    
+                    # Calcular superficies y validar contra las declaradas
+                    validar_superficies(poligonos)
                     
                     # Mostrar resultados
                     if poligonos:
@@ -499,134 +1398,27 @@ with tab1:
                         with col1:
                             st.metric("Total de campos", len(poligonos))
                         with col2:
-                            superficie_total = sum(p.get('superficie', 0) for p in poligonos)
+                            superficie_total = sum(superficie_efectiva(p) for p in poligonos)
                             st.metric("Superficie total", f"{superficie_total:,.1f} ha")
                         with col3:
                             st.metric("Campos activos", len(campos_activos))
                         
+                        campos_con_diferencia = [p for p in poligonos if p.get('superficie_difiere')]
+                        if campos_con_diferencia:
+                            st.info(f"ℹ️ {len(campos_con_diferencia)} campos con superficie declarada distinta a la calculada (más de {TOLERANCIA_SUPERFICIE:.0%})")
+                        
                         if poligonos_sin_coords:
                             st.info(f"ℹ️ {len(poligonos_sin_coords)} campos sin coordenadas disponibles")
                         
                         # Mostrar mapa si está disponible
                         if folium_disponible:
                             st.subheader("📍 Visualización de polígonos")
-                            mapa = crear_mapa_mobile(poligonos)
-                            if mapa:
-                                folium_static(mapa, width=None, height=600)
+                            mostrar_mapa(poligonos)
                         else:
-                            st.warning("Para visualizar mapas, instala folium y streamlit-folium")
+                            st.warning("Para visualizar mapas, instala folium")
                         
                         # Botones de descarga
-                        st.subheader("📥 Descargar resultados")
-                        col1, col2, col3 = st.columns(3)
-                        
-                        # Crear KML
-                        kml_content = f"""<?xml version="1.0" encoding="UTF-8"?>
-<kml xmlns="http://www.opengis.net/kml/2.2">
-<Document>
-  <name>Campos del productor</name>
-  <Style id="redPoly">
-    <LineStyle>
-      <color>ff0000ff</color>
-      <width>3</width>
-    </LineStyle>
-    <PolyStyle>
-      <color>7f0000ff</color>
-    </PolyStyle>
-  </Style>
-"""
-                        
-                        for pol in poligonos:
-                            kml_content += f"""
-  <Placemark>
-    <name>{pol['titular']}</name>
-    <description>Localidad: {pol['localidad']} - Superficie: {pol['superficie']:.1f} ha</description>
-    <styleUrl>#redPoly</styleUrl>
-    <Polygon>
-      <outerBoundaryIs>
-        <LinearRing>
-          <coordinates>
-"""
-                            for coord in pol['coords']:
-                                kml_content += f"{coord[0]},{coord[1]},0\n"
-                            
-                            kml_content += """
-          </coordinates>
-        </LinearRing>
-      </outerBoundaryIs>
-    </Polygon>
-  </Placemark>
-"""
-                        
-                        kml_content += "</Document></kml>"
-                        
-                        # Crear KMZ
-                        kmz_buffer = BytesIO()
-                        with zipfile.ZipFile(kmz_buffer, 'w', zipfile.ZIP_DEFLATED) as kmz:
-                            kmz.writestr("doc.kml", kml_content)
-                        
-                        kmz_buffer.seek(0)
-                        
-                        # Crear GeoJSON
-                        geojson_data = {
-                            "type": "FeatureCollection",
-                            "features": []
-                        }
-                        
-                        for pol in poligonos:
-                            feature = {
-                                "type": "Feature",
-                                "properties": {
-                                    "titular": pol['titular'],
-                                    "localidad": pol['localidad'],
-                                    "superficie": pol['superficie'],
-                                    "cuit": cuit_normalizado,
-                                    "estado": "Activo" if pol.get('activo', True) else "Inactivo",
-                                    "fecha_baja": pol.get('fecha_baja', None)
-                                },
-                                "geometry": {
-                                    "type": "Polygon",
-                                    "coordinates": [pol['coords']]
-                                }
-                            }
-                            geojson_data["features"].append(feature)
-                        
-                        geojson_str = json.dumps(geojson_data, indent=2)
-                        
-                        # Crear CSV con información
-                        df_export = pd.DataFrame([{
-                            'Titular': p['titular'],
-                            'Localidad': p['localidad'],
-                            'Superficie (ha)': p['superficie'],
-                            'Estado': 'Activo' if p.get('activo', True) else 'Inactivo',
-                            'Fecha de baja': p.get('fecha_baja', 'N/A'),
-                            'CUIT': p['cuit']
-                        } for p in poligonos])
-                        csv_data = df_export.to_csv(index=False).encode('utf-8')
-                        
-                        with col1:
-                            st.download_button(
-                                label="Descargar KMZ",
-                                data=kmz_buffer,
-                                file_name=f"campos_{cuit_normalizado.replace('-', '')}.kmz",
-                                mime="application/vnd.google-earth.kmz",
-                            )
-                        
-                        with col2:
-                            st.download_button(
-                                label="Descargar GeoJSON",
-                                data=geojson_str,
-                                file_name=f"campos_{cuit_normalizado.replace('-', '')}.geojson",
-                                mime="application/json",
-                            )
-                        
-                        with col3:
-                            st.download_button(
-                                label="Descargar CSV",
-                                data=csv_data,
-                                file_name=f"campos_{cuit_normalizado.replace('-', '')}.csv",
-                                mime="text/csv",
-                            )
+                        mostrar_descargas(poligonos, f"campos_{cuit_normalizado.replace('-', '')}")
                     else:
                         st.warning("No se pudieron obtener las ubicaciones de los campos")
                         
@@ -662,7 +1454,12 @@ with tab2:
                 colores = ['#FF4444', '#4444FF', '#FF8800', '#AA00FF', '#FF00AA', '#00AAFF']
                 cuit_colors = {}
                 
-                todos_poligonos = []
+                # Las descargas de la búsqueda anterior dejan de servir, liberar su archivo temporal
+                almacen_anterior = st.session_state.pop('almacen_lote', None)
+                if almacen_anterior is not None:
+                    almacen_anterior.cerrar()
+                
+                todos_poligonos = AlmacenPoligonos(MEMORIA_MAXIMA_LOTE_BYTES)
                 cuits_procesados = 0
                 cuits_con_error = []
                 
@@ -674,7 +1471,7 @@ with tab2:
                             cuit_normalizado = normalizar_cuit(cuit)
                             cuit_colors[cuit_normalizado] = colores[i % len(colores)]
                             
-                            campos = obtener_datos_por_cuit(cuit_normalizado)
+                            campos = cache_consultas.obtener_campos(cuit_normalizado, registrar=False)
                             
                             # Filtrar según selección
                             if tipo_busqueda_multi == "Solo campos activos":
@@ -682,13 +1479,15 @@ with tab2:
                             else:
                                 campos_a_procesar = campos
                             
+                            poligonos_cuit = []
+                            
                             for campo in campos_a_procesar:
                                 fecha_baja = campo.get('fecha_baja', None)
                                 # Intentar extraer polígono de los datos básicos
                                 if 'poligono' in campo and campo['poligono']:
                                     coords = extraer_coordenadas(campo['poligono'])
-                                    if coords:
-                                        todos_poligonos.append({
+                                    if coords is not None:
+                                        poligonos_cuit.append({
                                             'coords': coords,
                                             'titular': campo.get('titular', ''),
                                             'localidad': campo.get('localidad', ''),
@@ -700,14 +1499,14 @@ with tab2:
                                         continue
                                 
                                 # Si no hay polígono, consultar detalle
-                                resultado_detalle = consultar_campo_detalle(campo['renspa'])
+                                resultado_detalle = cache_consultas.obtener_detalle(campo['renspa'])
                                 
                                 if resultado_detalle and 'items' in resultado_detalle and resultado_detalle['items']:
                                     item_detalle = resultado_detalle['items'][0]
                                     if 'poligono' in item_detalle and item_detalle['poligono']:
                                         coords = extraer_coordenadas(item_detalle['poligono'])
-                                        if coords:
-                                            todos_poligonos.append({
+                                        if coords is not None:
+                                            poligonos_cuit.append({
                                                 'coords': coords,
                                                 'titular': campo.get('titular', ''),
                                                 'localidad': campo.get('localidad', ''),
@@ -716,8 +1515,10 @@ with tab2:
                                                 'fecha_baja': fecha_baja,
                                                 'activo': fecha_baja is None
                                             })
-                                
-                                time.sleep(TIEMPO_ESPERA)
+                            
+                            # Validar superficies del productor y guardarlo en el almacén
+                            for pol in validar_superficies(poligonos_cuit):
+                                todos_poligonos.agregar(pol)
                             
                             cuits_procesados += 1
                             progress_bar.progress((i + 1) / len(cuit_list))
@@ -726,29 +1527,52 @@ with tab2:
                             cuits_con_error.append(cuit)
                             continue
                     
-                    # Mostrar resumen
-                    col1, col2, col3, col4 = st.columns(4)
-                    with col1:
-                        st.metric("CUITs procesados", cuits_procesados)
-                    with col2:
-                        st.metric("Campos encontrados", len(todos_poligonos))
-                    with col3:
-                        superficie_total = sum(p.get('superficie', 0) for p in todos_poligonos)
-                        st.metric("Superficie total", f"{superficie_total:,.1f} ha")
-                    with col4:
-                        campos_activos = [p for p in todos_poligonos if p.get('activo', True)]
-                        st.metric("Campos activos", len(campos_activos))
-                    
-                    if todos_poligonos:
-                        # Mostrar mapa si está disponible
-                        if folium_disponible:
-                            st.subheader("📍 Visualización de polígonos")
-                            mapa = crear_mapa_mobile(todos_poligonos, cuit_colors=cuit_colors)
-                            if mapa:
-                                folium_static(mapa, width=None, height=600)
+                    try:
+                        # Mostrar resumen
+                        col1, col2, col3, col4 = st.columns(4)
+                        with col1:
+                            st.metric("CUITs procesados", cuits_procesados)
+                        with col2:
+                            st.metric("Campos encontrados", len(todos_poligonos))
+                        with col3:
+                            st.metric("Superficie total", f"{todos_poligonos.superficie_total:,.1f} ha")
+                        with col4:
+                            st.metric("Campos activos", todos_poligonos.activos)
+                        
+                        if todos_poligonos.con_diferencia:
+                            st.info(f"ℹ️ {todos_poligonos.con_diferencia} campos con superficie declarada distinta a la calculada (más de {TOLERANCIA_SUPERFICIE:.0%})")
+                        
+                        if todos_poligonos:
+                            # Mostrar mapa si está disponible
+                            if folium_disponible:
+                                st.subheader("📍 Visualización de polígonos")
+                                mostrar_mapa(todos_poligonos, cuit_colors=cuit_colors)
+                            else:
+                                st.warning("Para visualizar mapas, instala folium")
+                        
+                            mostrar_descargas(todos_poligonos, "campos_lote", diferido=True)
                         else:
-                            st.warning("Para visualizar mapas, instala folium y streamlit-folium")
-                    else:
-                        st.warning("No se encontraron campos para los CUITs ingresados")
+                            st.warning("No se encontraron campos para los CUITs ingresados")
+                    except BaseException:
+                        todos_poligonos.cerrar()
+                        raise
+                    
+                    # Las descargas se generan al pedirlas: el almacén queda en disco hasta la próxima búsqueda
+                    todos_poligonos.volcar()
+                    st.session_state['almacen_lote'] = todos_poligonos
         else:
             st.warning("Por favor, ingresá al menos un CUIT")
+
+# Estado de la cache de consultas
+with st.expander("⚙️ Estado de la cache"):
+    estadisticas_cache = cache_consultas.estadisticas()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Búsquedas", estadisticas_cache['consultas'])
+    with col2:
+        st.metric("Aciertos precargados", f"{estadisticas_cache['tasa_aciertos_calentados']:.0%}")
+    with col3:
+        if calentador:
+            st.metric("Llamadas del calentador", calentador.estadisticas()['llamadas_totales'])
+        else:
+            st.metric("Llamadas del calentador", "Desactivado")